@@ -80,7 +80,8 @@ def set_properties(project):
                                                       "compile"])
 
     project.set_property("distutils_entry_points", {
-        "distutils.commands": ["build_ext = karellen.clang_build_ext:ClangBuildExt"]
+        "distutils.commands": ["build_ext = karellen.clang_build_ext:ClangBuildExt",
+                               "verify_reproducible = karellen.clang_build_ext:ClangVerifyReproducible"]
     })
 
     project.set_property("distutils_classifiers", [
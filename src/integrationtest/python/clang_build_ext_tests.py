@@ -15,15 +15,25 @@
 # limitations under the License.
 #
 
+import hashlib
+import json
 import os
 import runpy
 import shutil
+import subprocess
 import sys
+import time
 import unittest
-from os.path import dirname, join as jp, exists
+from unittest.mock import patch
+from glob import glob
+from os.path import basename, dirname, join as jp, exists
+from distutils.unixccompiler import UnixCCompiler
 from tempfile import TemporaryDirectory
 from sysconfig import get_platform, get_python_version
 
+from karellen.clang_build_ext import (ClangCCompiler, DrakonBundle, write_drakon_bundle, DRAKON_MANIFEST_SUFFIX,
+                                      _PollingWatcher, _rebuild_targets)
+
 PLATFORM = f"{get_platform()}-cpython-{sys.version_info[0]}{sys.version_info[1]}"
 
 
@@ -45,8 +55,12 @@ class ClangBuildExtTest(unittest.TestCase):
                 sys.excepthook(*sys.exc_info())
 
     def build_test(self, dir_name, *extra_args, **env):
+        self.run_setup(dir_name, *(list(extra_args) + ["-b", self.build_dir, "-t", self.temp_dir]), **env)
+
+    def run_setup(self, dir_name, *args, **env):
         src_dir = jp(self.test_dir, dir_name)
-        shutil.copytree(src_dir, self.src_dir, symlinks=True, ignore_dangling_symlinks=True)
+        if not exists(self.src_dir):
+            shutil.copytree(src_dir, self.src_dir, symlinks=True, ignore_dangling_symlinks=True)
 
         old_env = dict(os.environ)
         old_sys_argv = list(sys.argv)
@@ -54,9 +68,7 @@ class ClangBuildExtTest(unittest.TestCase):
         try:
             script_path = jp(self.src_dir, "setup.py")
             sys.argv.clear()
-            sys.argv.extend([script_path] + list(extra_args) +
-                            ["-b", self.build_dir,
-                             "-t", self.temp_dir])
+            sys.argv.extend([script_path] + list(args))
             os.chdir(self.src_dir)
             os.environ.update(env)
             runpy.run_path(script_path)
@@ -174,5 +186,370 @@ class ClangBuildExtTest(unittest.TestCase):
 
         self.assertFalse(exists(f"{self.temp_dir}/src/module/module.bc"))
         self.assertFalse(exists(f"{self.temp_dir}/src/module/subdir/module1.bc"))
+
+    @unittest.skipUnless(shutil.which("llvm-bolt"), "llvm-bolt is not available")
+    def test_with_bolt_drakon(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-d",
+                        BOLT_WORKLOAD=f"{sys.executable} bolt_workload.py")
+
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        self.assertEqual(len(ext_files), 1)
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertIn(".note.bolt_info", sections)
+        self.assertIn(".drakon.//module.bc", sections)
+
+    def test_with_bolt_failed_workload(self):
+        bolt_cmds = []
+        spawn = ClangCCompiler.spawn
+
+        def fake_bolt_spawn(compiler, cmd, **kwargs):
+            if basename(cmd[0]) == "llvm-bolt":
+                bolt_cmds.append(cmd)
+                shutil.copyfile(cmd[1], cmd[cmd.index("-o") + 1])
+                return
+            return spawn(compiler, cmd, **kwargs)
+
+        for _ in range(2):
+            bolt_cmds.clear()
+            with patch.object(ClangCCompiler, "spawn", autospec=True, side_effect=fake_bolt_spawn), \
+                    self.assertRaises(SystemExit):
+                self.build_test("extension_1", "build_clib", "build_ext",
+                                BOLT_WORKLOAD=f"{sys.executable} -c 'raise SystemExit(1)'")
+
+            # The binary is left as linked, but out of date, so that the next build optimizes it again
+            self.assertEqual(len(bolt_cmds), 1)
+            self.assertIn("-instrument", bolt_cmds[0])
+            ext_files = glob(f"{self.build_dir}/test.*.so")
+            self.assertEqual(len(ext_files), 1)
+            self.assertEqual(os.stat(ext_files[0]).st_mtime_ns, 0)
+
+    def test_with_drakon_sidecar(self):
+        spawned = []
+        spawn = ClangCCompiler.spawn
+
+        def record_spawn(compiler, cmd, **kwargs):
+            spawned.append(cmd)
+            return spawn(compiler, cmd, **kwargs)
+
+        with patch.object(ClangCCompiler, "spawn", autospec=True, side_effect=record_spawn):
+            self.build_test("extension_1", "build_clib", "build_ext", "-S")
+
+        # The bundle reference is linked in, the binary is not rewritten
+        self.assertFalse([cmd for cmd in spawned if basename(cmd[0]) == "llvm-objcopy"])
+
+        self.assertTrue(exists(f"{self.temp_dir}/src/module/module.bc"))
+
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        self.assertEqual(len(ext_files), 1)
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertIn(".drakon_bundle", sections)
+        self.assertNotIn(".drakon.", sections)
+        bundle_ref = subprocess.check_output(["llvm-readelf", "-p", ".drakon_bundle", ext_files[0]],
+                                             universal_newlines=True)
+        self.assertIn(f"{basename(ext_files[0])}.drakon", bundle_ref)
+        self.assertIn("sha256:", bundle_ref)
+
+        with DrakonBundle(f"{ext_files[0]}.drakon") as bundle:
+            self.assertIn("//module.bc", bundle)
+            self.assertIn("//subdir/module1.bc", bundle)
+            self.assertIn("alib//alib.bc", bundle)
+            self.assertEqual(bytes(bundle["//module.bc"]), open(f"{self.temp_dir}/src/module/module.bc", "rb").read())
+
+    def test_with_drakon_sidecar_inplace(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-S", "--inplace")
+
+        ext_files = glob(f"{self.src_dir}/test.*.so")
+        self.assertEqual(len(ext_files), 1)
+        self.assertTrue(exists(f"{ext_files[0]}.drakon"))
+
+    def test_with_drakon_sidecar_install(self):
+        record_file = jp(self.target_dir.name, "record.txt")
+        self.run_setup("extension_1", "build_clib", "build_ext", "-S", "install",
+                       "--root", jp(self.target_dir.name, "root"), "--record", record_file)
+
+        with open(record_file) as f:
+            records = f.read().splitlines()
+        ext_files = [record for record in records if basename(record).startswith("test.") and
+                     record.endswith(".so")]
+        self.assertEqual(len(ext_files), 1)
+        self.assertIn(f"{ext_files[0]}.drakon", records)
+        self.assertTrue(exists(f"{self.target_dir.name}/root{ext_files[0]}.drakon"))
+
+    def test_drakon_bundle_modules_outlive_bundle(self):
+        os.makedirs(self.src_dir)
+        modules = []
+        for name, bitcode in (("//module.bc", b"BC\xc0\xde module"), ("alib//alib.bc", b"BC\xc0\xde alib")):
+            bc_file = jp(self.src_dir, basename(name))
+            with open(bc_file, "wb") as f:
+                f.write(bitcode)
+            modules.append((name, bc_file))
+        bundle_path = jp(self.src_dir, "test.so.drakon")
+        write_drakon_bundle(bundle_path, modules)
+
+        with DrakonBundle(bundle_path) as bundle:
+            bitcode = {name: bundle[name] for name in bundle}
+
+        self.assertEqual(bytes(bitcode["//module.bc"]), b"BC\xc0\xde module")
+        self.assertEqual(bytes(bitcode["alib//alib.bc"]), b"BC\xc0\xde alib")
+        with self.assertRaises(ValueError):
+            bundle["//module.bc"]
+        for view in bitcode.values():
+            view.release()
+
+    def test_shared_sources_compiled_once(self):
+        compiled_sources = []
+        _compile = UnixCCompiler._compile
+
+        def record_compile(compiler, obj, src, *args):
+            compiled_sources.append(src)
+            return _compile(compiler, obj, src, *args)
+
+        with patch.object(UnixCCompiler, "_compile", autospec=True, side_effect=record_compile):
+            self.build_test("extension_2", "build_ext", "-d")
+
+        self.assertEqual(len([src for src in compiled_sources if src.endswith("common.c")]), 1)
+        self.assertEqual(len(compiled_sources), 3)
+
+        self.assertTrue(exists(f"{self.temp_dir}/src/common/common.bc"))
+        self.assertEqual(len(glob(f"{self.build_dir}/ext_a.*.so")), 1)
+        self.assertEqual(len(glob(f"{self.build_dir}/ext_b.*.so")), 1)
+
+    def test_watch_targets(self):
+        with patch("karellen.clang_build_ext._watch") as watch:
+            self.build_test("extension_1", "build_clib", "build_ext", "-w")
+
+        targets = watch.call_args[0][0]
+        self.assertEqual([target.name for target in targets], ["alib", "shlib", "test"])
+        self.assertIn("alib", targets[2].libraries)
+
+        self.assertTrue(exists(f"{self.src_dir}/build/temp.{PLATFORM}/src/alib/alib.d"))
+        self.assertTrue(exists(f"{self.temp_dir}/src/shlib/shlib.d"))
+        self.assertTrue(exists(f"{self.temp_dir}/src/module/module.d"))
+
+    def test_watch_rebuilds_affected_targets(self):
+        compiled_sources = []
+        linked_outputs = []
+        archived_outputs = []
+        builds = []
+        rebuild_results = []
+        _compile = UnixCCompiler._compile
+        link = ClangCCompiler.link
+        create_static_lib = ClangCCompiler.create_static_lib
+
+        def record_compile(compiler, obj, src, *args):
+            compiled_sources.append(src)
+            return _compile(compiler, obj, src, *args)
+
+        def record_link(compiler, target_desc, objects, output_filename, *args, **kwargs):
+            linked_outputs.append(basename(output_filename))
+            return link(compiler, target_desc, objects, output_filename, *args, **kwargs)
+
+        def record_create_static_lib(compiler, objects, output_libname, *args, **kwargs):
+            archived_outputs.append(output_libname)
+            return create_static_lib(compiler, objects, output_libname, *args, **kwargs)
+
+        def record_rebuild_targets(targets, changed):
+            rebuilt, failed = _rebuild_targets(targets, changed)
+            rebuild_results.append(([target.name for target in rebuilt], [target.name for target in failed]))
+            return rebuilt, failed
+
+        def change_sources():
+            builds.append((list(compiled_sources), list(linked_outputs), list(archived_outputs)))
+            compiled_sources.clear()
+            linked_outputs.clear()
+            archived_outputs.clear()
+
+            # Well past the outputs regardless of the file system timestamp granularity
+            future_ns = time.time_ns() + 10 ** 10 * len(builds)
+            if len(builds) == 1:
+                os.utime(jp(self.src_dir, "src", "alib", "alib.h"), ns=(future_ns, future_ns))
+            elif len(builds) == 2:
+                alib_c = jp(self.src_dir, "src", "alib", "alib.c")
+                with open(alib_c, "a") as f:
+                    f.write("\nthis is not C;\n")
+                os.utime(alib_c, ns=(future_ns, future_ns))
+            else:
+                raise KeyboardInterrupt()
+
+        watcher = _PollingWatcher()
+        with patch.object(watcher, "wait", side_effect=change_sources), \
+                patch("karellen.clang_build_ext._new_watcher", return_value=watcher), \
+                patch("karellen.clang_build_ext._rebuild_targets", side_effect=record_rebuild_targets), \
+                patch.object(UnixCCompiler, "_compile", autospec=True, side_effect=record_compile), \
+                patch.object(ClangCCompiler, "link", autospec=True, side_effect=record_link), \
+                patch.object(ClangCCompiler, "create_static_lib", autospec=True,
+                             side_effect=record_create_static_lib):
+            self.build_test("extension_1", "build_clib", "build_ext", "-w")
+
+        self.assertEqual(len(builds), 3)
+
+        # Only the source including the changed header is recompiled and the extension linking the library
+        # is relinked, while the static library not linking anything is left alone
+        compiled_sources, linked_outputs, archived_outputs = builds[1]
+        self.assertEqual(compiled_sources, ["src/alib/alib.c"])
+        self.assertEqual(archived_outputs, ["alib"])
+        self.assertEqual(len(linked_outputs), 1)
+        self.assertTrue(linked_outputs[0].startswith("test."))
+        self.assertEqual(rebuild_results[0], (["alib", "test"], []))
+
+        # Nothing depending on a library that failed to rebuild is relinked
+        compiled_sources, linked_outputs, _ = builds[2]
+        self.assertEqual(compiled_sources, ["src/alib/alib.c"])
+        self.assertEqual(linked_outputs, [])
+        self.assertEqual(rebuild_results[1], ([], ["alib"]))
+        self.assertTrue(exists(f"{self.src_dir}/build/temp.{PLATFORM}/libalib.a"))
+
+    def test_watch_inplace(self):
+        ext_contents = []
+
+        def read_ext_files():
+            ext_files = glob(f"{self.src_dir}/test.*.so") + glob(f"{self.build_dir}/test.*.so")
+            self.assertEqual(len(ext_files), 2)
+            contents = []
+            for ext_file in ext_files:
+                with open(ext_file, "rb") as f:
+                    contents.append(hashlib.sha256(f.read()).hexdigest())
+            return contents
+
+        def change_sources():
+            ext_contents.append(read_ext_files())
+            if len(ext_contents) == 1:
+                module_c = jp(self.src_dir, "src", "module", "module.c")
+                with open(module_c, "a") as f:
+                    f.write("\nint module_extra(void) { return 42; }\n")
+                future_ns = time.time_ns() + 10 ** 10
+                os.utime(module_c, ns=(future_ns, future_ns))
+            else:
+                raise KeyboardInterrupt()
+
+        watcher = _PollingWatcher()
+        with patch.object(watcher, "wait", side_effect=change_sources), \
+                patch("karellen.clang_build_ext._new_watcher", return_value=watcher):
+            self.build_test("extension_1", "build_clib", "build_ext", "-w", "--inplace", "-f")
+
+        self.assertEqual(len(ext_contents), 2)
+        # The rebuilt extension is built into the build directory and copied into the source tree over the old one
+        (initial_inplace, initial_built), (inplace, built) = ext_contents
+        self.assertEqual(initial_inplace, initial_built)
+        self.assertNotEqual(built, initial_built)
+        self.assertEqual(inplace, built)
+
+    def test_drakon_reuses_unchanged_library_bitcode(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-d")
+
+        self.assertEqual(len(glob(f"{self.temp_dir}/test.*{DRAKON_MANIFEST_SUFFIX}")), 1)
+
+        with patch.object(ClangCCompiler, "_extract_library_bitcode", autospec=True) as extract_library_bitcode:
+            self.build_test("extension_1", "build_clib", "build_ext", "-d", "-f")
+
+        extract_library_bitcode.assert_not_called()
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertIn(".drakon.alib//alib.bc", sections)
+
+    def test_drakon_extracts_changed_library_members_only(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-d")
+
+        spawned = []
+        spawn = ClangCCompiler.spawn
+
+        def record_spawn(compiler, cmd, **kwargs):
+            spawned.append(cmd)
+            return spawn(compiler, cmd, **kwargs)
+
+        alib_c = jp(self.src_dir, "src", "alib", "alib.c")
+        with open(alib_c, "a") as f:
+            f.write("\nint alib_extra(void) { return 42; }\n")
+        # build_clib ignores -f when deciding which sources to recompile
+        mtime = time.time() + 2
+        os.utime(alib_c, (mtime, mtime))
+        with patch.object(ClangCCompiler, "spawn", autospec=True, side_effect=record_spawn):
+            self.build_test("extension_1", "build_clib", "-f", "build_ext", "-d", "-f")
+
+        extracted = [cmd[-1] for cmd in spawned if basename(cmd[0]) == "llvm-ar" and "xN" in cmd]
+        self.assertEqual(extracted, ["alib.bc"])
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertEqual(sections.count(".drakon.alib//"), 3)
+        self.assertEqual(sections.count(".drakon."), 5)
+
+    def test_drakon_post_link_without_relink(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-d")
+
+        spawned = []
+        spawn = ClangCCompiler.spawn
+
+        def record_spawn(compiler, cmd, **kwargs):
+            spawned.append(cmd)
+            return spawn(compiler, cmd, **kwargs)
+
+        def objcopy_cmds():
+            return [cmd for cmd in spawned if basename(cmd[0]) == "llvm-objcopy"]
+
+        # The linker finds the binary up-to-date and none of the modules have changed
+        with patch.object(ClangCCompiler, "spawn", autospec=True, side_effect=record_spawn), \
+                patch.object(ClangCCompiler, "_need_link", return_value=False):
+            self.build_test("extension_1", "build_clib", "build_ext", "-d", "-f")
+        self.assertEqual(objcopy_cmds(), [])
+
+        # A changed module replaces the previously embedded section of the binary that has not been relinked
+        with open(jp(self.src_dir, "src", "module", "module.c"), "a") as f:
+            f.write("\nint module_extra(void) { return 42; }\n")
+        spawned.clear()
+        with patch.object(ClangCCompiler, "spawn", autospec=True, side_effect=record_spawn), \
+                patch.object(ClangCCompiler, "_need_link", return_value=False):
+            self.build_test("extension_1", "build_clib", "build_ext", "-d", "-f")
+
+        self.assertEqual(len(objcopy_cmds()), 1)
+        self.assertIn("--remove-section", objcopy_cmds()[0])
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertEqual(sections.count(".drakon.//module.bc"), 1)
+        self.assertEqual(sections.count(".drakon.alib//alib.bc"), 1)
+        self.assertEqual(sections.count(".drakon."), 5)
+
+    def test_drakon_same_extension_names_in_different_packages(self):
+        self.build_test("extension_3", "build_ext", "-d", "-j", "2")
+        self.build_test("extension_3", "build_ext", "-d", "-j", "2")
+
+        manifests = glob(f"{self.temp_dir}/_speedups.*{DRAKON_MANIFEST_SUFFIX}")
+        self.assertEqual(len(manifests), 2)
+        manifest_modules = []
+        for manifest in manifests:
+            with open(manifest) as f:
+                manifest_modules.append(list(json.load(f)["modules"]))
+        self.assertEqual(sorted(manifest_modules), [["//a_speedups.bc"], ["//b_speedups.bc"]])
+
+        for pkg in ("a", "b"):
+            ext_files = glob(f"{self.build_dir}/pkg_{pkg}/_speedups.*.so")
+            self.assertEqual(len(ext_files), 1)
+            sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+            self.assertEqual(sections.count(".drakon."), 1)
+            self.assertIn(f".drakon.//{pkg}_speedups.bc", sections)
+
+    def test_with_cmd_line_drakon_reproducible(self):
+        self.build_test("extension_1", "build_clib", "build_ext", "-d", "-r")
+
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertIn(".drakon.//module.bc", sections)
+        self.assertIn(".drakon.//subdir/module1.bc", sections)
+        self.assertIn(".drakon.alib//alib.bc", sections)
+
+    def test_with_cmd_line_drakon_reproducible_build_temp_above_source(self):
+        # Library members are named from the archive regardless of where they are extracted to
+        self.run_setup("extension_1", "build_clib", "build_ext", "-d", "-r",
+                       "-b", self.build_dir, "-t", self.target_dir.name)
+
+        ext_files = glob(f"{self.build_dir}/test.*.so")
+        sections = subprocess.check_output(["llvm-readelf", "-S", ext_files[0]], universal_newlines=True)
+        self.assertIn(".drakon.//module.bc", sections)
+        self.assertIn(".drakon.alib//alib.bc", sections)
+        self.assertNotIn(".drakon.alib//src/", sections)
+
+    def test_verify_reproducible(self):
+        self.run_setup("extension_1", "verify_reproducible", DRAKON="1")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,17 @@
+import ctypes
+import os
+from importlib.machinery import ExtensionFileLoader
+from importlib.util import spec_from_loader, module_from_spec
+
+target = os.environ["BOLT_TARGET"]
+
+if os.path.basename(target).startswith("test."):
+    loader = ExtensionFileLoader("test", target)
+    module = module_from_spec(spec_from_loader("test", loader))
+    loader.exec_module(module)
+    for _ in range(1000):
+        module.test()
+else:
+    lib = ctypes.CDLL(target)
+    for _ in range(1000):
+        lib.foo()
@@ -1,7 +1,7 @@
 from setuptools import setup, Extension
 from setuptools.extension import Library
 
-from karellen.clang_build_ext import ClangBuildExt, ClangBuildClib
+from karellen.clang_build_ext import ClangBuildExt, ClangBuildClib, ClangVerifyReproducible
 
 setup(name="test",
       version="1.0.0",
@@ -17,5 +17,6 @@ setup(name="test",
       libraries=[("alib", {"sources": ["src/alib/*.c", "src/alib/**/*.c"]})
                  ],
       cmdclass={"build_ext": ClangBuildExt,
-                "build_clib": ClangBuildClib},
+                "build_clib": ClangBuildClib,
+                "verify_reproducible": ClangVerifyReproducible},
       )
@@ -0,0 +1,19 @@
+from setuptools import setup, Extension
+
+from karellen.clang_build_ext import ClangBuildExt, ClangBuildClib
+
+setup(name="test",
+      version="1.0.0",
+      description="Python test module",
+      author="Karellen, Inc.",
+      author_email="supervisor@karellen.co",
+      ext_modules=[Extension("ext_a",
+                             ["src/common/*.c", "src/ext_a/*.c"],
+                             include_dirs=["src/common"]),
+                   Extension("ext_b",
+                             ["src/common/*.c", "src/ext_b/*.c"],
+                             include_dirs=["src/common"]),
+                   ],
+      cmdclass={"build_ext": ClangBuildExt,
+                "build_clib": ClangBuildClib},
+      )
@@ -0,0 +1,5 @@
+#include "common.h"
+
+long common_value(void) {
+    return 42l;
+}
@@ -0,0 +1,6 @@
+#ifndef COMMON_H
+#define COMMON_H
+
+long common_value(void);
+
+#endif
@@ -0,0 +1,23 @@
+#include <Python.h>
+#include "common.h"
+
+static PyObject *method_value(PyObject *self, PyObject *args) {
+    return PyLong_FromLong(common_value());
+}
+
+static PyMethodDef ExtMethods[] = {
+    {"value", method_value, METH_VARARGS, "Python test function"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef extModule = {
+    PyModuleDef_HEAD_INIT,
+    "ext_b",
+    "Python test module",
+    -1,
+    ExtMethods
+};
+
+PyMODINIT_FUNC PyInit_ext_b(void) {
+    return PyModule_Create(&extModule);
+}
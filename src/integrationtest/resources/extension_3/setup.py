@@ -0,0 +1,17 @@
+from setuptools import setup, Extension
+
+from karellen.clang_build_ext import ClangBuildExt, ClangBuildClib
+
+setup(name="test",
+      version="1.0.0",
+      description="Python test module",
+      author="Karellen, Inc.",
+      author_email="supervisor@karellen.co",
+      ext_modules=[Extension("pkg_a._speedups",
+                             ["src/pkg_a/*.c"]),
+                   Extension("pkg_b._speedups",
+                             ["src/pkg_b/*.c"]),
+                   ],
+      cmdclass={"build_ext": ClangBuildExt,
+                "build_clib": ClangBuildClib},
+      )
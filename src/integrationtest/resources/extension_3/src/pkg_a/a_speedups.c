@@ -0,0 +1,22 @@
+#include <Python.h>
+
+static PyObject *method_name(PyObject *self, PyObject *args) {
+    return PyUnicode_FromString("pkg_a");
+}
+
+static PyMethodDef SpeedupsMethods[] = {
+    {"name", method_name, METH_VARARGS, "Python test function"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef speedupsModule = {
+    PyModuleDef_HEAD_INIT,
+    "pkg_a._speedups",
+    "Python test module",
+    -1,
+    SpeedupsMethods
+};
+
+PyMODINIT_FUNC PyInit__speedups(void) {
+    return PyModule_Create(&speedupsModule);
+}
@@ -15,24 +15,39 @@
 # limitations under the License.
 #
 
+import ctypes
+import ctypes.util
+import filecmp
+import hashlib
 import inspect
+import json
+import mmap
 import os
+import re
+import select
+import shutil
+import struct
 import subprocess
 import sys
+import threading
+import time
 from contextlib import contextmanager
+from functools import partial
 from distutils import ccompiler
 from distutils import log
 from distutils.debug import DEBUG
-from distutils.errors import DistutilsExecError
+from distutils.errors import DistutilsExecError, DistutilsError, CCompilerError
 from distutils.spawn import find_executable
 from distutils.unixccompiler import UnixCCompiler
 from distutils.util import split_quoted
-from glob import glob
-from os.path import exists, dirname, commonpath
+from glob import glob, has_magic
+from os.path import exists, dirname, basename, commonpath
 from tempfile import TemporaryDirectory
 
+from setuptools import Command
 from setuptools.command.build_clib import build_clib as _build_clib
-from setuptools.command.build_ext import build_ext as _build_ext
+from setuptools.command.build_ext import build_ext as _build_ext, libtype as _libtype
+from setuptools.extension import Library
 
 _has_dry_run = 'dry_run' in inspect.signature(ccompiler.new_compiler).parameters
 
@@ -40,13 +55,299 @@ COMMON_OPTIONS = [
     ("drakon", "d",
      "build extension with Drakon enhancements"),
     ("thin", "T",
-     "build thin static libraries")
+     "build thin static libraries"),
+    ("watch", "w",
+     "keep running and incrementally rebuild when sources or headers change"),
+    ("reproducible", "r",
+     "produce reproducible outputs independent of the build paths and time")
 ]
 
 COMMON_BOOLEAN_OPTIONS = [
-    "drakon", "thin"
+    "drakon", "thin", "watch", "reproducible"
 ]
 
+# Used for SOURCE_DATE_EPOCH in the reproducible mode unless set in the environment
+REPRODUCIBLE_SOURCE_DATE_EPOCH = "0"
+REPRODUCIBLE_BUILD_TEMP = "/build-temp"
+
+WATCH_POLL_INTERVAL = 0.5
+WATCH_SETTLE_DELAY = 0.1
+
+BUILD_EXT_OPTIONS = [
+    ("bolt-workload=", None,
+     "optimize linked extensions with llvm-bolt using the profile collected by running the workload command"),
+    ("drakon-sidecar", "S",
+     "write Drakon bitcode into a sidecar bundle next to the extension instead of embedding it (implies --drakon)")
+]
+
+BUILD_EXT_BOOLEAN_OPTIONS = [
+    "drakon-sidecar"
+]
+
+DRAKON_BUNDLE_MAGIC = b"DRAKONB\0"
+DRAKON_BUNDLE_VERSION = 1
+DRAKON_BUNDLE_SUFFIX = ".drakon"
+DRAKON_BUNDLE_SECTION = ".drakon_bundle"
+
+DRAKON_MANIFEST_VERSION = 1
+DRAKON_MANIFEST_SUFFIX = ".drakon-manifest.json"
+
+# magic, version, module count
+_DRAKON_BUNDLE_HEADER = struct.Struct("<8sII")
+# data offset, data size, name size; followed by the UTF-8 name
+_DRAKON_BUNDLE_ENTRY = struct.Struct("<QQI")
+_DRAKON_BUNDLE_ALIGNMENT = 16
+
+_AR_MAGIC = b"!<arch>\n"
+# name, modification time, owner, group and mode are skipped; size, terminator
+_AR_HEADER = struct.Struct("16s32x10s2s")
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _get_fingerprint(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_drakon_manifest(manifest_file):
+    """Read the manifest of the previous Drakon post-link, returns an empty manifest if there is no usable one"""
+    manifest = None
+    if manifest_file:
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+    if not isinstance(manifest, dict) or manifest.get("version") != DRAKON_MANIFEST_VERSION:
+        manifest = {}
+
+    manifest.setdefault("output", None)
+    manifest.setdefault("sidecar", False)
+    manifest.setdefault("archives", {})
+    manifest.setdefault("modules", {})
+    manifest.setdefault("bundle", None)
+    return manifest
+
+
+def _write_drakon_manifest(manifest_file, manifest):
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def _get_drakon_cache_key(output_filename):
+    """Name of the Drakon manifest and cache directory of the `output_filename` unique among the outputs sharing
+    the build temp, but independent of the location of the project, so that reproducible builds are not affected"""
+    output_path = os.path.relpath(os.path.abspath(output_filename))
+    return f"{basename(output_filename)}.{hashlib.sha256(output_path.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _hash_archive_members(lib_path):
+    """SHA-256 of the bitcode members of the regular `ar` archive `lib_path` keyed by `(name, occurrence)`,
+    the same way the members are addressed by `llvm-ar xN`. Returns None if the archive format is not recognized."""
+    member_hashes = {}
+    occurrences = {}
+    long_names = b""
+    with open(lib_path, "rb") as f:
+        if f.read(len(_AR_MAGIC)) != _AR_MAGIC:
+            return None
+        while True:
+            header = f.read(_AR_HEADER.size)
+            if not header:
+                break
+            if len(header) != _AR_HEADER.size:
+                return None
+            raw_name, size, fmag = _AR_HEADER.unpack(header)
+            if fmag != b"`\n":
+                return None
+            size = int(size)
+            data_start = f.tell()
+
+            raw_name = raw_name.rstrip(b" ")
+            if raw_name.startswith(b"#1/"):
+                # BSD, the name follows the header
+                name_size = int(raw_name[3:])
+                raw_name = f.read(name_size).rstrip(b"\0")
+            elif raw_name == b"//":
+                # GNU long name table
+                long_names = f.read(size)
+            elif raw_name.startswith(b"/") and raw_name[1:].isdigit():
+                name_offset = int(raw_name[1:])
+                raw_name = long_names[name_offset:long_names.index(b"\n", name_offset)]
+            name = raw_name.decode("utf-8")
+            if name.endswith("/") and name not in ("/", "//"):
+                name = name[:-1]
+
+            if name.endswith(".bc"):
+                occurrences[name] = occurrence = occurrences.get(name, 0) + 1
+                digest = hashlib.sha256()
+                digest.update(f.read(size - (f.tell() - data_start)))
+                member_hashes[(name, occurrence)] = digest.hexdigest()
+
+            # Members are aligned to 2 bytes
+            f.seek(data_start + size + size % 2)
+    return member_hashes
+
+
+def write_drakon_bundle(bundle_path, modules):
+    """Write Drakon bitcode `modules`, a list of `(name, bc_file)` pairs, into a single indexed bundle.
+
+    The bundle consists of a header, an index of `(offset, size, name)` entries and the bitcode of every module
+    aligned to 16 bytes, so that modules can be accessed in place once the bundle is memory-mapped.
+    Returns the SHA-256 hex digest of the bundle.
+    """
+    encoded_names = [name.encode("utf-8") for name, _ in modules]
+    sizes = [os.stat(bc_file).st_size for _, bc_file in modules]
+
+    def align(value):
+        return (value + _DRAKON_BUNDLE_ALIGNMENT - 1) // _DRAKON_BUNDLE_ALIGNMENT * _DRAKON_BUNDLE_ALIGNMENT
+
+    offset = align(_DRAKON_BUNDLE_HEADER.size +
+                   sum(_DRAKON_BUNDLE_ENTRY.size + len(name) for name in encoded_names))
+    index = []
+    for name, size in zip(encoded_names, sizes):
+        index.append((offset, size, name))
+        offset = align(offset + size)
+
+    digest = hashlib.sha256()
+    tmp_path = f"{bundle_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        def write(data):
+            f.write(data)
+            digest.update(data)
+
+        write(_DRAKON_BUNDLE_HEADER.pack(DRAKON_BUNDLE_MAGIC, DRAKON_BUNDLE_VERSION, len(index)))
+        for entry_offset, size, name in index:
+            write(_DRAKON_BUNDLE_ENTRY.pack(entry_offset, size, len(name)))
+            write(name)
+
+        for (entry_offset, size, _), (_, bc_file) in zip(index, modules):
+            write(b"\0" * (entry_offset - f.tell()))
+            with open(bc_file, "rb") as bc_f:
+                write(bc_f.read())
+    os.replace(tmp_path, bundle_path)
+    return digest.hexdigest()
+
+
+class DrakonBundle:
+    """Memory-mapped read-only view of a Drakon sidecar bundle written by `write_drakon_bundle`.
+
+    Behaves as a mapping of `<lib>//<path>` module names to `memoryview`s of the module bitcode.
+    The `memoryview`s remain valid after the bundle is closed, until they are released.
+    """
+
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        with open(bundle_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, count = _DRAKON_BUNDLE_HEADER.unpack_from(self._mmap, 0)
+        if magic != DRAKON_BUNDLE_MAGIC or version != DRAKON_BUNDLE_VERSION:
+            self.close()
+            raise ValueError(f"{bundle_path!r} is not a version {DRAKON_BUNDLE_VERSION} Drakon bundle")
+
+        self._index = {}
+        pos = _DRAKON_BUNDLE_HEADER.size
+        for _ in range(count):
+            offset, size, name_size = _DRAKON_BUNDLE_ENTRY.unpack_from(self._mmap, pos)
+            pos += _DRAKON_BUNDLE_ENTRY.size
+            self._index[bytes(self._mmap[pos:pos + name_size]).decode("utf-8")] = (offset, size)
+            pos += name_size
+
+    def __getitem__(self, name):
+        offset, size = self._index[name]
+        if self._view is None:
+            raise ValueError(f"Drakon bundle {self.bundle_path!r} is closed")
+        return self._view[offset:offset + size]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def close(self):
+        view, self._view = self._view, None
+        bundle_mmap, self._mmap = self._mmap, None
+        if view is not None:
+            view.release()
+        if bundle_mmap is not None:
+            try:
+                bundle_mmap.close()
+            except BufferError:
+                # Modules handed out are still in use, the bundle is unmapped once the last of them is released
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _get_dep_filename(obj):
+    """Dependency file written by `clang -MMD` for the object `obj`"""
+    return f"{os.path.splitext(obj)[0]}.d"
+
+
+def _read_dep_file(dep_file):
+    """Read the prerequisites from a Makefile dependency file, returns None if there is no dependency file"""
+    try:
+        with open(dep_file) as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+
+    content = content.replace("\\\n", " ")
+    _, _, prerequisites = content.partition(": ")
+    return [prerequisite.replace("\\ ", " ")
+            for prerequisite in re.split(r"(?<!\\)\s+", prerequisites) if prerequisite]
+
+
+class _CompiledUnit:
+    """Translation unit compiled into a specific object with a specific effective command line"""
+
+    def __init__(self, command):
+        self.command = command
+        self.compiled = False
+        self.done = threading.Event()
+
+
+class _DrakonLink:
+    """Bitcode to be added to a linked binary along with the previous and the new Drakon manifests"""
+
+    def __init__(self):
+        self.manifest_file = None
+        self.cache_dir = None
+        self.manifest = None
+        self.new_manifest = None
+        self.add_bc_files = {}
+
 
 class ClangCCompiler(UnixCCompiler):
     executables = {
@@ -62,12 +363,28 @@ class ClangCCompiler(UnixCCompiler):
         'archiver': ["llvm-ar", "rcs"],
         'ranlib': None,
         'objcopy': ["llvm-objcopy"],
-        'readelf': ["llvm-readelf"]
+        'readelf': ["llvm-readelf"],
+        'bolt': ["llvm-bolt"],
+        'merge_fdata': ["merge-fdata"]
     }
 
-    def __init__(self, verbose=0, dry_run=0, force=0, drakon=False, thin=False):
+    bolt_instrument_options = ["-instrument", "--instrumentation-file-append-pid"]
+    bolt_optimize_options = ["--reorder-blocks=ext-tsp", "--reorder-functions=hfsort", "--split-functions",
+                             "--split-all-cold", "--split-eh", "--dyno-stats"]
+
+    def __init__(self, verbose=0, dry_run=0, force=0, drakon=False, thin=False, bolt_workload=None,
+                 drakon_sidecar=False, track_dependencies=False, reproducible=False):
         self.drakon = drakon
         self.thin = thin
+        self.reproducible = reproducible
+        self.drakon_sidecar = drakon_sidecar
+        self.track_dependencies = track_dependencies
+        self.incremental = False
+        self.compiled_units = 0
+        self.reused_units = 0
+        self._units = {}
+        self._units_lock = threading.Lock()
+        self.bolt_workload = bolt_workload
         if _has_dry_run:
             super().__init__(verbose, dry_run, force)
         else:
@@ -90,90 +407,309 @@ class ClangCCompiler(UnixCCompiler):
             build_temp=None,
             target_lang=None,
     ):
-        super().link(target_desc, objects, output_filename, output_dir, libraries, library_dirs, runtime_library_dirs,
-                     export_symbols, debug, extra_preargs, extra_postargs, build_temp, target_lang)
+        if output_dir is not None:
+            output_filename = os.path.join(output_dir, output_filename)
+            output_dir = None
 
-        if not self.drakon:
-            return
+        if self.bolt_workload:
+            # BOLT needs the static relocations to be able to move the code around
+            extra_postargs = list(extra_postargs or []) + ["-Wl,--emit-relocs"]
 
+        temp_dirs = []
+        try:
+            drakon_link = None
+            if self.drakon:
+                drakon_link = self._prepare_drakon_link(objects, output_filename, libraries, library_dirs,
+                                                        runtime_library_dirs, build_temp, temp_dirs)
+                if self.drakon_sidecar:
+                    # The reference to the bundle is linked in, so that the binary is not rewritten afterwards
+                    objects = list(objects) + [self._write_drakon_sidecar(output_filename, drakon_link, build_temp,
+                                                                          temp_dirs)]
+
+            old_mtime = _get_mtime(output_filename)
+            super().link(target_desc, objects, output_filename, output_dir, libraries, library_dirs,
+                         runtime_library_dirs, export_symbols, debug, extra_preargs, extra_postargs, build_temp,
+                         target_lang)
+
+            # BOLT goes first so that Drakon sections are added to the final optimized binary
+            if self.bolt_workload and _get_mtime(output_filename) != old_mtime:
+                self._bolt_optimize(output_filename, build_temp)
+
+            if drakon_link:
+                self._finish_drakon_link(output_filename, drakon_link)
+        finally:
+            for temp_dir in temp_dirs:
+                temp_dir.cleanup()
+
+    def _prepare_drakon_link(self, objects, output_filename, libraries, library_dirs, runtime_library_dirs,
+                             build_temp, temp_dirs):
+        """Collect the bitcode of the `objects` and of the linked static libraries along with the manifests"""
         libraries, library_dirs, runtime_library_dirs = self._fix_lib_args(libraries,
                                                                            library_dirs,
                                                                            runtime_library_dirs)
 
+        # Named relative to what the files have in common, so the names do not depend on the build directories
         def get_section_name(lib_name, lib_file, source_lib):
             common_path = commonpath((lib_file, source_lib))
             if common_path and not common_path.endswith(os.sep):
                 common_path += os.sep
             return f"{lib_name}//{lib_file[len(common_path):]}"
 
+        drakon_link = _DrakonLink()
+        if build_temp:
+            cache_key = _get_drakon_cache_key(output_filename)
+            drakon_link.manifest_file = f"{build_temp}{os.sep}{cache_key}{DRAKON_MANIFEST_SUFFIX}"
+            drakon_link.cache_dir = f"{build_temp}{os.sep}drakon{os.sep}{cache_key}"
+        drakon_link.manifest = manifest = _read_drakon_manifest(drakon_link.manifest_file)
+        drakon_link.new_manifest = new_manifest = {"version": DRAKON_MANIFEST_VERSION,
+                                                   "sidecar": bool(self.drakon_sidecar),
+                                                   "archives": {}}
+
         add_bc_files = {}
         for obj in objects:
             bc_file = f"{obj[:-2]}.bc"
             log.debug("Adding %s", bc_file)
             add_bc_files[bc_file] = get_section_name("", bc_file, commonpath(objects))
 
-        lib_extract_paths = {}
-        try:
-            archiver = self.archiver[0]
-            for lib in libraries:
-                for lib_dir in library_dirs:
-                    lib_path = f"{lib_dir}{os.sep}lib{lib}.a"
-                    if exists(lib_path):
-                        thin_lib = False
-                        with open(lib_path, "rb") as f:
-                            if f.read(7) == b"!<thin>":
-                                thin_lib = True
-
-                        lib_extract_paths[lib_path] = lib_extract_dir = TemporaryDirectory()
-                        log.debug(f"Processing {'thin ' if thin_lib else ''}library %s", lib_path)
-                        lib_files = self.spawn_out([archiver, "t", lib_path]).splitlines()
-                        if thin_lib:
-                            for lib_file in lib_files:
-                                if not lib_file.endswith(".bc"):
-                                    continue
-                                log.debug("Adding %s", lib_file)
-                                add_bc_files[lib_file] = get_section_name(lib, lib_file, lib_path)
+        archiver = self.archiver[0]
+        for lib in libraries:
+            for lib_dir in library_dirs:
+                lib_path = f"{lib_dir}{os.sep}lib{lib}.a"
+                if exists(lib_path):
+                    lib_fingerprint = _get_fingerprint(lib_path)
+                    cached_lib = manifest["archives"].get(lib_path)
+                    if (cached_lib and cached_lib["fingerprint"] == lib_fingerprint and "members" in cached_lib and
+                            all(exists(bc_file) for bc_file, _ in cached_lib["modules"])):
+                        log.debug("Reusing bitcode of unchanged library %s", lib_path)
+                        lib_bc_files = dict(cached_lib["modules"])
+                        lib_members = cached_lib["members"]
+                    else:
+                        cached_members = {}
+                        if drakon_link.cache_dir:
+                            lib_extract_dir = f"{drakon_link.cache_dir}{os.sep}lib{lib}"
+                            os.makedirs(lib_extract_dir, exist_ok=True)
+                            if cached_lib:
+                                cached_members = cached_lib.get("members") or {}
                         else:
-                            files_in_ar = {}
-                            for l in lib_files:
-                                if l in files_in_ar:
-                                    files_in_ar[l] += 1
-                                else:
-                                    files_in_ar[l] = 1
-
-                            for file in files_in_ar.keys():
-                                if not file.endswith(".bc"):
-                                    continue
-
-                                count = files_in_ar[file]
-                                for i in range(1, count + 1):
-                                    extracted_name = f"{lib_extract_dir.name}{os.sep}{file[0:-3]}" \
-                                                     f"{f'.{i!s}' if count > 1 else ''}.bc"
-                                    log.debug("Extracting %s", extracted_name)
-                                    parents_dir = dirname(file)
-                                    os.makedirs(f"{lib_extract_dir.name}{os.sep}{parents_dir}", exist_ok=True)
-                                    self.spawn(
-                                        [archiver, "--output", lib_extract_dir.name, "xN", str(i), lib_path, file])
-                                    if count > 1:
-                                        self.move_file(f"{lib_extract_dir.name}{os.sep}{file}", extracted_name)
-                                    add_bc_files[extracted_name] = get_section_name(lib,
-                                                                                    extracted_name[len(
-                                                                                        lib_extract_dir.name) + 1:],
-                                                                                    lib_path)
-
-                        break
-
-            cmd_line = self.objcopy[:]
-            for bc_file, bc_name in add_bc_files.items():
-                section_name = f".drakon.{bc_name}"
-                cmd_line.extend(["--add-section", f"{section_name}={bc_file}",
-                                 "--set-section-flags", f"{section_name}=noload,readonly,contents"])
-            cmd_line.append(output_filename)
-            self.spawn(cmd_line)
-
-        finally:
-            for lib, path in lib_extract_paths.items():
-                path.cleanup()
+                            lib_extract_tmp = TemporaryDirectory()
+                            temp_dirs.append(lib_extract_tmp)
+                            lib_extract_dir = lib_extract_tmp.name
+                        lib_bc_files, lib_members = self._extract_library_bitcode(archiver, lib, lib_path,
+                                                                                  lib_extract_dir, get_section_name,
+                                                                                  cached_members)
+
+                    new_manifest["archives"][lib_path] = {"fingerprint": lib_fingerprint,
+                                                          "modules": list(lib_bc_files.items()),
+                                                          "members": lib_members}
+                    add_bc_files.update(lib_bc_files)
+                    break
+
+        if self.reproducible:
+            add_bc_files = dict(sorted(add_bc_files.items(), key=lambda bc_item: bc_item[1]))
+
+        drakon_link.add_bc_files = add_bc_files
+        new_manifest["modules"] = {bc_name: _hash_file(bc_file) for bc_file, bc_name in add_bc_files.items()}
+        return drakon_link
+
+    def _finish_drakon_link(self, output_filename, drakon_link):
+        """Embed the bitcode into the linked binary unless it is up-to-date and record the manifest"""
+        manifest, new_manifest = drakon_link.manifest, drakon_link.new_manifest
+        manifest_file = drakon_link.manifest_file
+
+        if not self.drakon_sidecar:
+            # When the output has not been relinked it still carries the results of the previous post-link
+            output_relinked = manifest["output"] != _get_fingerprint(output_filename)
+            if not output_relinked and not manifest["sidecar"] and manifest["modules"] == new_manifest["modules"]:
+                log.info("skipping Drakon post-link of %s (up-to-date)", output_filename)
+                if manifest_file and manifest["archives"] != new_manifest["archives"]:
+                    new_manifest["output"] = manifest["output"]
+                    _write_drakon_manifest(manifest_file, new_manifest)
+                return
+
+            remove_sections = []
+            if not output_relinked:
+                if manifest["sidecar"]:
+                    remove_sections.append(DRAKON_BUNDLE_SECTION)
+                else:
+                    remove_sections.extend(f".drakon.{bc_name}" for bc_name in manifest["modules"])
+
+            self._embed_drakon_sections(output_filename, drakon_link.add_bc_files, remove_sections)
+
+        if manifest_file:
+            new_manifest["output"] = _get_fingerprint(output_filename)
+            _write_drakon_manifest(manifest_file, new_manifest)
+
+    def _extract_library_bitcode(self, archiver, lib, lib_path, lib_extract_dir, get_section_name,
+                                 cached_members=None):
+        """Extract the bitcode from the library `lib_path` into `lib_extract_dir` unless the library is thin.
+
+        Members previously extracted into `lib_extract_dir` whose contents hash the same as recorded in
+        `cached_members` are reused instead of being extracted again.
+        Returns the mapping of bitcode files to their section names and the hashes of the extracted members.
+        """
+        thin_lib = False
+        with open(lib_path, "rb") as f:
+            if f.read(7) == b"!<thin>":
+                thin_lib = True
+
+        lib_bc_files = {}
+        lib_members = {}
+        log.debug(f"Processing {'thin ' if thin_lib else ''}library %s", lib_path)
+        lib_files = self.spawn_out([archiver, "t", lib_path]).splitlines()
+        if thin_lib:
+            for lib_file in lib_files:
+                if not lib_file.endswith(".bc"):
+                    continue
+                log.debug("Adding %s", lib_file)
+                lib_bc_files[lib_file] = get_section_name(lib, lib_file, lib_path)
+        else:
+            member_hashes = _hash_archive_members(lib_path) or {}
+            cached_members = cached_members or {}
+
+            files_in_ar = {}
+            for l in lib_files:
+                if l in files_in_ar:
+                    files_in_ar[l] += 1
+                else:
+                    files_in_ar[l] = 1
+
+            for file in files_in_ar.keys():
+                if not file.endswith(".bc"):
+                    continue
+
+                count = files_in_ar[file]
+                for i in range(1, count + 1):
+                    extracted_name = f"{lib_extract_dir}{os.sep}{file[0:-3]}" \
+                                     f"{f'.{i!s}' if count > 1 else ''}.bc"
+                    member_hash = member_hashes.get((file, i))
+                    if member_hash and cached_members.get(extracted_name) == member_hash and exists(extracted_name):
+                        log.debug("Reusing unchanged %s", extracted_name)
+                    else:
+                        log.debug("Extracting %s", extracted_name)
+                        parents_dir = dirname(file)
+                        os.makedirs(f"{lib_extract_dir}{os.sep}{parents_dir}", exist_ok=True)
+                        self.spawn(
+                            [archiver, "--output", lib_extract_dir, "xN", str(i), lib_path, file])
+                        if count > 1:
+                            self.move_file(f"{lib_extract_dir}{os.sep}{file}", extracted_name)
+                    if member_hash:
+                        lib_members[extracted_name] = member_hash
+                    # Members are named after their names in the archive, which are not file paths
+                    lib_bc_files[extracted_name] = f"{lib}//{extracted_name[len(lib_extract_dir) + 1:]}"
+
+            # Members removed from the library must not linger in the cache
+            for walk_dir, _, files in os.walk(lib_extract_dir):
+                for file in files:
+                    extracted_name = f"{walk_dir}{os.sep}{file}"
+                    if extracted_name not in lib_bc_files:
+                        os.unlink(extracted_name)
+        return lib_bc_files, lib_members
+
+    def _embed_drakon_sections(self, output_filename, add_bc_files, remove_sections=()):
+        cmd_line = self.objcopy[:]
+        for section_name in remove_sections:
+            cmd_line.extend(["--remove-section", section_name])
+        for bc_file, bc_name in add_bc_files.items():
+            section_name = f".drakon.{bc_name}"
+            cmd_line.extend(["--add-section", f"{section_name}={bc_file}",
+                             "--set-section-flags", f"{section_name}=noload,readonly,contents"])
+        cmd_line.append(output_filename)
+        self.spawn(cmd_line)
+
+    def _write_drakon_sidecar(self, output_filename, drakon_link, build_temp, temp_dirs):
+        """Write the bitcode into a bundle next to the `output_filename` unless it is up-to-date.
+
+        Returns the object carrying the `.drakon_bundle` reference section, which is linked into the binary.
+        """
+        manifest, new_manifest = drakon_link.manifest, drakon_link.new_manifest
+        bundle_path = f"{output_filename}{DRAKON_BUNDLE_SUFFIX}"
+        cached_bundle = manifest["bundle"]
+        if (manifest["sidecar"] and manifest["modules"] == new_manifest["modules"] and cached_bundle and
+                cached_bundle["fingerprint"] == _get_fingerprint(bundle_path)):
+            log.debug("Reusing up-to-date Drakon bundle %s", bundle_path)
+            digest = cached_bundle["sha256"]
+        else:
+            log.info("writing Drakon bundle %s", bundle_path)
+            digest = write_drakon_bundle(bundle_path, [(bc_name, bc_file)
+                                                       for bc_file, bc_name in drakon_link.add_bc_files.items()])
+        new_manifest["bundle"] = {"fingerprint": _get_fingerprint(bundle_path), "sha256": digest}
+
+        if drakon_link.cache_dir:
+            ref_dir = drakon_link.cache_dir
+            os.makedirs(ref_dir, exist_ok=True)
+        else:
+            ref_tmp = TemporaryDirectory()
+            temp_dirs.append(ref_tmp)
+            ref_dir = ref_tmp.name
+        ref_src = f"{ref_dir}{os.sep}drakon_bundle.s"
+        ref_obj = f"{ref_dir}{os.sep}drakon_bundle.o"
+
+        reference = f"{basename(bundle_path)}\0sha256:{digest}\0".encode("utf-8")
+        ref_asm = (f'\t.section {DRAKON_BUNDLE_SECTION},"",@progbits\n'
+                   f"\t.byte {','.join(str(ref_byte) for ref_byte in reference)}\n"
+                   # Otherwise the linker may consider the stack executable
+                   '\t.section .note.GNU-stack,"",@progbits\n')
+
+        # An unchanged reference must not make the binary stale, but a binary previously linked
+        # without a reference has to be relinked
+        old_ref_asm = None
+        if manifest["sidecar"] and exists(ref_obj) and exists(ref_src):
+            with open(ref_src) as f:
+                old_ref_asm = f.read()
+        if old_ref_asm != ref_asm:
+            with open(ref_src, "w") as f:
+                f.write(ref_asm)
+            prefix_map_args = self._get_prefix_map_args(build_temp) if self.reproducible else []
+            self.spawn(self.compiler_so + prefix_map_args + ["-Wno-unused-command-line-argument",
+                                                             "-c", ref_src, "-o", ref_obj])
+        return ref_obj
+
+    def _bolt_optimize(self, output_filename, build_temp=None):
+        """Instrument the linked binary with BOLT, run the workload against the instrumented binary placed
+        at `output_filename` and then rewrite the original binary using the collected profile.
+
+        Instrumentation is used instead of sampling, so no hardware performance counters are required.
+        The workload receives the path of the instrumented binary in the `BOLT_TARGET` environment variable.
+        """
+        if build_temp:
+            os.makedirs(build_temp, exist_ok=True)
+
+        with TemporaryDirectory(dir=build_temp) as bolt_dir:
+            original = f"{bolt_dir}{os.sep}{basename(output_filename)}"
+            instrumented = f"{original}.instrumented"
+            # The workload may run in a different directory
+            profile_prefix = os.path.abspath(f"{bolt_dir}{os.sep}profile")
+
+            log.info("optimizing %s with BOLT", output_filename)
+            shutil.copy2(output_filename, original)
+            try:
+                self.spawn(self.bolt + [original, "-o", instrumented,
+                                        f"--instrumentation-file={profile_prefix}"] + self.bolt_instrument_options)
+                shutil.copyfile(instrumented, output_filename)
+
+                env = dict(os.environ)
+                env["BOLT_TARGET"] = os.path.abspath(output_filename)
+                self.spawn_out(split_quoted(self.bolt_workload), env=env, stdout=None)
+                shutil.copyfile(original, output_filename)
+
+                profiles = sorted(glob(f"{profile_prefix}*"))
+                if not profiles:
+                    raise DistutilsExecError(f"BOLT workload {self.bolt_workload!r} did not produce "
+                                             f"a profile for {output_filename!r}")
+                if len(profiles) > 1:
+                    profile = f"{profile_prefix}.merged"
+                    with open(profile, "w") as f:
+                        self.spawn_out(self.merge_fdata + profiles, stdout=f)
+                else:
+                    profile = profiles[0]
+
+                self.spawn(self.bolt + [original, "-o", output_filename, f"--data={profile}"] +
+                           self.bolt_optimize_options)
+            except BaseException:
+                # Put the binary back as linked, but out of date, so that the next build relinks and optimizes it
+                shutil.copyfile(original, output_filename)
+                os.utime(output_filename, ns=(0, 0))
+                raise
 
     def create_static_lib(self, objects, output_libname, output_dir=None, debug=0, target_lang=None):
         # Add all the bytecode into the ar library
@@ -185,10 +721,97 @@ class ClangCCompiler(UnixCCompiler):
 
         super().create_static_lib(objects, output_libname, output_dir, debug, target_lang)
 
+    def compile(self, sources, output_dir=None, macros=None, include_dirs=None, debug=0, extra_preargs=None,
+                extra_postargs=None, depends=None):
+        if self.reproducible:
+            extra_preargs = self._get_prefix_map_args(output_dir) + list(extra_preargs or [])
+        return super().compile(sources, output_dir, macros, include_dirs, debug, extra_preargs, extra_postargs,
+                               depends)
+
+    def _get_prefix_map_args(self, output_dir):
+        """Map the source root and the build temp root to fixed paths in everything the compiler emits"""
+        prefix_maps = {}
+        output_dir = output_dir or self.output_dir
+        if output_dir:
+            for path in (os.path.abspath(output_dir), os.path.realpath(output_dir)):
+                prefix_maps[path] = REPRODUCIBLE_BUILD_TEMP
+        for path in (os.getcwd(), os.path.realpath(os.getcwd())):
+            prefix_maps.setdefault(path, ".")
+
+        # The last matching prefix map wins, so the most specific ones go last
+        return [f"-ffile-prefix-map={path}={mapped_path}"
+                for path, mapped_path in sorted(prefix_maps.items(), key=lambda prefix_map: len(prefix_map[0]))]
+
+    def spawn(self, cmd, **kwargs):
+        if self.reproducible and "env" not in kwargs:
+            env = dict(os.environ)
+            env.setdefault("SOURCE_DATE_EPOCH", REPRODUCIBLE_SOURCE_DATE_EPOCH)
+            kwargs["env"] = env
+        super().spawn(cmd, **kwargs)
+
+    def _compile(self, obj, src, ext, cc_args, extra_postargs, pp_opts):
+        # Extensions sharing sources produce the same objects in the build temp, so a translation unit that has
+        # already been compiled with the same effective command line is reused instead of being compiled again
+        command = (os.path.abspath(src), tuple(self.compiler_so), tuple(cc_args), tuple(extra_postargs))
+        unit_key = os.path.normpath(os.path.abspath(obj))
+        with self._units_lock:
+            unit = self._units.get(unit_key)
+            reuse = unit is not None and unit.command == command
+            if not reuse:
+                self._units[unit_key] = unit = _CompiledUnit(command)
+
+        if reuse:
+            unit.done.wait()
+            if unit.compiled:
+                with self._units_lock:
+                    self.reused_units += 1
+                log.info("reusing %s compiled from %s", obj, src)
+                return
+
+        try:
+            if self.incremental and not self.force and self._is_up_to_date(obj, src):
+                log.debug("skipping %s (up-to-date)", src)
+                unit.compiled = True
+                return
+            super()._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+            unit.compiled = True
+            with self._units_lock:
+                self.compiled_units += 1
+        finally:
+            unit.done.set()
+
+    def _is_up_to_date(self, obj, src):
+        outputs = [obj]
+        if self.drakon:
+            outputs.append(f"{obj[:-2]}.bc")
+        output_mtimes = [_get_mtime(output) for output in outputs]
+        if None in output_mtimes:
+            return False
+
+        prerequisites = _read_dep_file(_get_dep_filename(obj))
+        if prerequisites is None:
+            return False
+
+        oldest_output = min(output_mtimes)
+        for prerequisite in [src] + prerequisites:
+            mtime = _get_mtime(prerequisite)
+            if mtime is None or mtime > oldest_output:
+                return False
+        return True
+
+    def reset_units(self):
+        """Forget compiled translation units, so that the next build compiles (or checks) everything again"""
+        with self._units_lock:
+            self._units.clear()
+            self.compiled_units = 0
+            self.reused_units = 0
+
     def _get_cc_args(self, pp_opts, debug, before):
         cc_args = super()._get_cc_args(pp_opts, debug, before)
         if self.drakon:
             cc_args = ["--save-temps=obj", "-fno-discard-value-names"] + cc_args
+        if self.track_dependencies:
+            cc_args = ["-MMD"] + cc_args
         return cc_args
 
     def set_executable(self, key, value):
@@ -203,6 +826,11 @@ class ClangCCompiler(UnixCCompiler):
             value = value[:]
             value.append("--thin")
 
+        # Zero timestamps, UIDs and GIDs of the archive members
+        if self.reproducible and key == "archiver" and len(value) > 1 and "D" not in value[1]:
+            value = value[:]
+            value[1] = value[1].replace("U", "") + "D"
+
         setattr(self, key, value)
 
     def spawn_out(self, cmd, search_path=1, verbose=0, dry_run=0,
@@ -265,15 +893,225 @@ class ClangCCompiler(UnixCCompiler):
             return proc.stdout
 
 
+class _InotifyWatcher:
+    """Waits for changes in directories using Linux inotify"""
+    kind = "inotify"
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_IGNORED = 0x00008000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF)
+
+    # wd, mask, cookie, len; followed by the name of `len` bytes
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._inotify_add_watch.restype = ctypes.c_int
+
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches = {}
+
+    def watch(self, dirs):
+        watched = set(self._watches.values())
+        for watch_dir in dirs:
+            if watch_dir in watched:
+                continue
+            wd = self._inotify_add_watch(self.fd, os.fsencode(watch_dir), self.WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = watch_dir
+                watched.add(watch_dir)
+
+    def wait(self):
+        select.select([self.fd], [], [])
+        # Let the burst of changes (e.g. a save from an editor, a branch switch) settle
+        while select.select([self.fd], [], [], WATCH_SETTLE_DELAY)[0]:
+            self._read_events()
+
+    def _read_events(self):
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size + name_len
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingWatcher:
+    """Fallback watcher that simply wakes up periodically to look for changes"""
+    kind = "polling"
+
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+
+    def watch(self, dirs):
+        pass
+
+    def wait(self):
+        time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def _new_watcher():
+    if sys.platform.startswith("linux"):
+        try:
+            return _InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            log.warn("inotify is not available (%s), falling back to polling", e)
+    return _PollingWatcher()
+
+
+def _glob_roots(pattern):
+    """Directories that have to be watched to notice files appearing that match the glob `pattern`"""
+    parts = pattern.split(os.sep)
+    root_parts = []
+    for part in parts[:-1]:
+        if has_magic(part):
+            break
+        root_parts.append(part)
+    root = os.sep.join(root_parts) or os.curdir
+
+    if len(root_parts) == len(parts) - 1:
+        return [root]
+    return [walk_dir for walk_dir, _, _ in os.walk(root)]
+
+
+class _WatchTarget:
+    """Library or extension tracked by the watch mode along with all of its inputs"""
+
+    def __init__(self, name, patterns, depends, compiler, build_temp, build, libraries=(), library=False):
+        self.name = name
+        self.patterns = patterns
+        self.depends = list(depends or [])
+        self.compiler = compiler
+        self.build_temp = build_temp
+        self.build = build
+        self.libraries = set(libraries)
+        self.library = library
+        self.inputs = ()
+
+    def snapshot(self):
+        """Current sources and modification times of all the inputs, including the headers recorded
+        in the dependency files of the objects"""
+        sources = []
+        for pattern in self.patterns:
+            sources.extend(glob(pattern))
+
+        inputs = set(sources)
+        inputs.update(self.depends)
+        for obj in self.compiler.object_filenames(sources, output_dir=self.build_temp):
+            inputs.update(_read_dep_file(_get_dep_filename(obj)) or ())
+        self.inputs = inputs
+
+        return sources, {path: _get_mtime(path) for path in inputs}
+
+    def watch_dirs(self):
+        watch_dirs = {dirname(path) or os.curdir for path in self.inputs}
+        for pattern in self.patterns:
+            watch_dirs.update(_glob_roots(pattern))
+        return {watch_dir for watch_dir in watch_dirs if os.path.isdir(watch_dir)}
+
+
+def _watch(targets, rebuild):
+    """Watch the inputs of the `targets` and call `rebuild` with the list of changed targets until interrupted.
+
+    `rebuild` returns the lists of the rebuilt and of the failed targets.
+    """
+    compilers = {target.compiler for target in targets if isinstance(target.compiler, ClangCCompiler)}
+    for compiler in compilers:
+        compiler.incremental = True
+
+    watcher = _new_watcher()
+    try:
+        snapshots = {target: target.snapshot() for target in targets}
+        log.info("watching %d targets for changes (%s), press Ctrl-C to stop", len(targets), watcher.kind)
+        while True:
+            watch_dirs = set()
+            for target in targets:
+                watch_dirs.update(target.watch_dirs())
+            watcher.watch(sorted(watch_dirs))
+            watcher.wait()
+
+            changed = [target for target in targets if target.snapshot() != snapshots[target]]
+            if not changed:
+                continue
+
+            start = time.monotonic()
+            for compiler in compilers:
+                compiler.reset_units()
+            rebuilt, failed = rebuild(changed)
+            elapsed = time.monotonic() - start
+            if failed:
+                log.info("rebuilt %s, failed to rebuild %s in %.2fs",
+                         ", ".join(target.name for target in rebuilt) or "nothing",
+                         ", ".join(target.name for target in failed), elapsed)
+            else:
+                log.info("rebuilt %s in %.2fs", ", ".join(target.name for target in rebuilt), elapsed)
+
+            # Dependency files have been updated by the rebuild
+            snapshots = {target: target.snapshot() for target in targets}
+    except KeyboardInterrupt:
+        log.info("stopped watching")
+    finally:
+        watcher.close()
+
+
+def _rebuild_targets(targets, changed):
+    """Rebuild the `changed` targets and everything linking the libraries among them, in the order of `targets`.
+
+    Returns the lists of the rebuilt targets and of the targets that failed to rebuild.
+    """
+    changed = set(changed)
+    rebuilt = []
+    failed = []
+    rebuilt_libraries = set()
+    for target in targets:
+        if target not in changed and not (target.libraries & rebuilt_libraries):
+            continue
+        try:
+            target.build()
+        except (DistutilsError, CCompilerError) as e:
+            log.error("error: failed to rebuild %s: %s", target.name, e)
+            failed.append(target)
+            continue
+        rebuilt.append(target)
+        if target.library:
+            rebuilt_libraries.add(target.name)
+    return rebuilt, failed
+
+
 class ClangBuildExt(_build_ext):
-    user_options = list(_build_ext.user_options) + COMMON_OPTIONS
-    boolean_options = list(_build_ext.boolean_options) + COMMON_BOOLEAN_OPTIONS
+    user_options = list(_build_ext.user_options) + COMMON_OPTIONS + BUILD_EXT_OPTIONS
+    boolean_options = list(_build_ext.boolean_options) + COMMON_BOOLEAN_OPTIONS + BUILD_EXT_BOOLEAN_OPTIONS
 
     def initialize_options(self) -> None:
         super().initialize_options()
 
         self.drakon = None
         self.thin = None
+        self.bolt_workload = None
+        self.drakon_sidecar = None
+        self.watch = None
+        self.reproducible = None
 
     def finalize_options(self) -> None:
         with self.customized_compiler():
@@ -285,34 +1123,140 @@ class ClangBuildExt(_build_ext):
             if self.compiler is None:
                 self.compiler = "clang"
 
+            if self.drakon_sidecar is None:
+                self.drakon_sidecar = os.environ.get("DRAKON_SIDECAR", False)
+
             if self.drakon is None:
                 self.drakon = os.environ.get("DRAKON", False)
 
+            if self.drakon_sidecar:
+                self.drakon = True
+
             if self.thin is None:
                 self.thin = os.environ.get("THIN", False)
 
+            if self.reproducible is None:
+                self.reproducible = os.environ.get("REPRODUCIBLE", False)
+
+            if self.bolt_workload is None:
+                self.bolt_workload = os.environ.get("BOLT_WORKLOAD")
+
             super().finalize_options()
 
     def run(self):
         with self.customized_compiler():
             super().run()
 
+            if self.watch:
+                self.watch_extensions()
+
+    def watch_extensions(self):
+        """Incrementally rebuild libraries and extensions whenever their sources or headers change"""
+        targets = []
+        if self.distribution.has_c_libraries():
+            self.run_command("build_clib")
+            build_clib = self.get_finalized_command("build_clib")
+            if isinstance(build_clib, ClangBuildClib):
+                targets.extend(build_clib.get_watch_targets())
+
+        for ext in self.extensions:
+            libraries = (ext.libraries or []) + (self.libraries or [])
+            if isinstance(ext, Library) and _libtype == "static":
+                # Static libraries are archived, not linked against other libraries
+                libraries = []
+            targets.append(_WatchTarget(ext.name, ext.sources, ext.depends, self.compiler, self.build_temp,
+                                        partial(self._rebuild_extension, ext), libraries=libraries))
+
+        def rebuild(changed):
+            # Build into the build directory and copy into the source tree afterwards, the same as the initial build
+            old_inplace, self.inplace = self.inplace, 0
+            try:
+                rebuilt, failed = _rebuild_targets(targets, changed)
+            finally:
+                self.inplace = old_inplace
+            if old_inplace and rebuilt:
+                self.copy_extensions_to_source()
+            return rebuilt, failed
+
+        _watch(targets, rebuild)
+
+    def _rebuild_extension(self, ext):
+        # The linker only compares the output to the objects, so make it stale to relink against changed libraries
+        ext_path = self.get_ext_fullpath(ext.name)
+        if exists(ext_path):
+            os.utime(ext_path, ns=(0, 0))
+
+        force = self.force
+        self.force = True
+        try:
+            self.build_extension(ext)
+        finally:
+            self.force = force
+
+    def build_extensions(self):
+        super().build_extensions()
+
+        if isinstance(self.compiler, ClangCCompiler):
+            total_units = self.compiler.compiled_units + self.compiler.reused_units
+            if total_units:
+                log.info("compiled %d translation units, reused %d of %d (%.1f%%) shared between extensions",
+                         self.compiler.compiled_units, self.compiler.reused_units, total_units,
+                         100.0 * self.compiler.reused_units / total_units)
+
     def build_extension(self, ext):
         sources = ext.sources
         try:
             ext.sources = []
             for src in sources:
-                ext.sources.extend(glob(src))
+                ext.sources.extend(sorted(glob(src)) if self.reproducible else glob(src))
             super().build_extension(ext)
         finally:
-            ext.source = sources
+            ext.sources = sources
+
+    def copy_extensions_to_source(self):
+        super().copy_extensions_to_source()
+
+        for inplace_bundle, regular_bundle in self._get_drakon_bundle_mapping():
+            if exists(regular_bundle):
+                self.copy_file(regular_bundle, inplace_bundle, level=self.verbose)
+
+    def get_outputs(self):
+        outputs = super().get_outputs()
+        if self.inplace or not self.drakon_sidecar:
+            # In-place outputs come from the output mapping
+            return outputs
+        return outputs + [regular_bundle for _, regular_bundle in self._get_drakon_bundle_mapping()]
+
+    def get_output_mapping(self):
+        mapping = super().get_output_mapping()
+        mapping.update(self._get_drakon_bundle_mapping())
+        return mapping
+
+    def _get_drakon_bundle_mapping(self):
+        """In-place and regular paths of the Drakon sidecar bundles of the linked extensions"""
+        if not self.drakon_sidecar:
+            return []
+
+        build_py = self.get_finalized_command('build_py')
+        bundle_mapping = []
+        for ext in self.extensions:
+            if isinstance(ext, Library) and _libtype == "static":
+                # Static libraries are archived, not linked, so there is no bundle
+                continue
+            inplace_file, regular_file = self._get_inplace_equivalent(build_py, ext)
+            bundle_mapping.append((f"{inplace_file}{DRAKON_BUNDLE_SUFFIX}", f"{regular_file}{DRAKON_BUNDLE_SUFFIX}"))
+        return bundle_mapping
 
     def new_compiler(self, plat=None, compiler=None, verbose=0, dry_run=0, force=0):
         if compiler == "clang":
             if _has_dry_run:
-                return ClangCCompiler(None, dry_run, force, drakon=self.drakon, thin=self.thin)
+                return ClangCCompiler(None, dry_run, force, drakon=self.drakon, thin=self.thin,
+                                      bolt_workload=self.bolt_workload, drakon_sidecar=self.drakon_sidecar,
+                                      track_dependencies=bool(self.watch), reproducible=self.reproducible)
             else:
-                return ClangCCompiler(None, force, drakon=self.drakon, thin=self.thin)
+                return ClangCCompiler(None, force, drakon=self.drakon, thin=self.thin,
+                                      bolt_workload=self.bolt_workload, drakon_sidecar=self.drakon_sidecar,
+                                      track_dependencies=bool(self.watch), reproducible=self.reproducible)
         if _has_dry_run:
             return self._old_new_compiler(plat, compiler, verbose, dry_run, force)
         else:
@@ -348,12 +1292,17 @@ class ClangBuildClib(_build_clib):
         super().initialize_options()
         self.drakon = None
         self.thin = None
+        self.watch = None
+        self.track_dependencies = None
+        self.reproducible = None
 
     def finalize_options(self) -> None:
         self.set_undefined_options(
             'build_ext',
             ('drakon', 'drakon'),
             ('thin', 'thin'),
+            ('watch', 'track_dependencies'),
+            ('reproducible', 'reproducible'),
             ('compiler', 'compiler')
         )
 
@@ -363,9 +1312,13 @@ class ClangBuildClib(_build_clib):
     def new_compiler(self, plat=None, compiler=None, verbose=0, dry_run=0, force=0):
         if compiler == "clang":
             if _has_dry_run:
-                return ClangCCompiler(None, dry_run, force, drakon=self.drakon, thin=self.thin)
+                return ClangCCompiler(None, dry_run, force, drakon=self.drakon, thin=self.thin,
+                                      track_dependencies=bool(self.watch or self.track_dependencies),
+                                      reproducible=self.reproducible)
             else:
-                return ClangCCompiler(None, force, drakon=self.drakon, thin=self.thin)
+                return ClangCCompiler(None, force, drakon=self.drakon, thin=self.thin,
+                                      track_dependencies=bool(self.watch or self.track_dependencies),
+                                      reproducible=self.reproducible)
         if _has_dry_run:
             return self._old_new_compiler(plat, compiler, verbose, dry_run, force)
         else:
@@ -393,6 +1346,32 @@ class ClangBuildClib(_build_clib):
         with self.customized_compiler():
             super().run()
 
+            if self.watch and self.libraries:
+                targets = self.get_watch_targets()
+                _watch(targets, partial(_rebuild_targets, targets))
+
+    def get_watch_targets(self):
+        return [_WatchTarget(lib_name, build_info.get("sources") or [], build_info.get("depends"), self.compiler,
+                             self.build_temp, partial(self._rebuild_library, lib_name, build_info), library=True)
+                for lib_name, build_info in self.libraries or []]
+
+    def _rebuild_library(self, lib_name, build_info):
+        # Members of the removed sources must not linger in the archive, so it is recreated from scratch
+        lib_file = self.compiler.library_filename(lib_name, output_dir=self.build_clib)
+        old_lib_file = f"{lib_file}.old"
+        if exists(lib_file):
+            os.replace(lib_file, old_lib_file)
+
+        try:
+            self.build_libraries([(lib_name, build_info)])
+        except BaseException:
+            if exists(old_lib_file):
+                os.replace(old_lib_file, lib_file)
+            raise
+
+        if exists(old_lib_file):
+            os.unlink(old_lib_file)
+
     def build_libraries(self, libraries):
         new_libraries = []
         for lib_name, sources_map in libraries:
@@ -400,7 +1379,90 @@ class ClangBuildClib(_build_clib):
             if sources:
                 new_sources = []
                 for src in sources:
-                    new_sources.extend(glob(src))
-                new_libraries.append((lib_name, {"sources": new_sources}))
+                    new_sources.extend(sorted(glob(src)) if self.reproducible else glob(src))
+                new_build_info = {"sources": new_sources}
+                if getattr(self.compiler, "track_dependencies", False):
+                    new_build_info["obj_deps"] = self._get_obj_deps(new_sources)
+                new_libraries.append((lib_name, new_build_info))
 
         super().build_libraries(new_libraries)
+
+    def _get_obj_deps(self, sources):
+        """Headers of every source as recorded in the dependency files of the previously compiled objects"""
+        obj_deps = {}
+        for src, obj in zip(sources, self.compiler.object_filenames(sources, output_dir=self.build_temp)):
+            prerequisites = _read_dep_file(_get_dep_filename(obj))
+            if prerequisites:
+                obj_deps[src] = prerequisites
+        return obj_deps
+
+
+class ClangVerifyReproducible(Command):
+    description = "build twice in different directories in the reproducible mode and compare the outputs"
+
+    user_options = [
+        ("build-commands=", None,
+         "space-separated setup commands to run for every build [default: build_clib build_ext]"),
+    ]
+
+    ignore_patterns = ("build", "dist", "*.egg-info", ".eggs", ".git", "__pycache__")
+
+    def initialize_options(self) -> None:
+        self.build_commands = None
+
+    def finalize_options(self) -> None:
+        if self.build_commands is None:
+            self.build_commands = "build_clib build_ext"
+        self.build_commands = split_quoted(self.build_commands)
+
+    def run(self):
+        src_dir = os.path.abspath(dirname(self.distribution.script_name) or os.curdir)
+        script_name = basename(self.distribution.script_name)
+
+        env = dict(os.environ)
+        env["REPRODUCIBLE"] = "1"
+        env.setdefault("SOURCE_DATE_EPOCH", REPRODUCIBLE_SOURCE_DATE_EPOCH)
+
+        with TemporaryDirectory() as first_dir, TemporaryDirectory() as second_dir:
+            build_dirs = []
+            for work_dir in (first_dir, second_dir):
+                # Same relative layout in different absolute locations
+                tree_dir = f"{work_dir}{os.sep}src"
+                shutil.copytree(src_dir, tree_dir, symlinks=True, ignore=shutil.ignore_patterns(*self.ignore_patterns))
+
+                cmd = [sys.executable, script_name] + self.build_commands
+                log.info("building in %s: %s", tree_dir, subprocess.list2cmdline(cmd))
+                if subprocess.run(cmd, cwd=tree_dir, env=env).returncode:
+                    raise DistutilsExecError(f"build in {tree_dir!r} failed")
+                build_dirs.append(f"{tree_dir}{os.sep}build")
+
+            differences = self.compare_build_dirs(*build_dirs)
+
+        if differences:
+            raise DistutilsError(f"build is not reproducible, {len(differences)} outputs differ: "
+                                 f"{', '.join(differences)}")
+        log.info("build is reproducible")
+
+    def compare_build_dirs(self, first_build_dir, second_build_dir):
+        """Relative paths of all the outputs that differ between the two build directories"""
+
+        def list_outputs(build_dir):
+            outputs = set()
+            for walk_dir, _, files in os.walk(build_dir):
+                for file in files:
+                    # The manifest records file modification times, which are expected to differ
+                    if file.endswith(DRAKON_MANIFEST_SUFFIX):
+                        continue
+                    outputs.add(os.path.relpath(f"{walk_dir}{os.sep}{file}", build_dir))
+            return outputs
+
+        first_outputs = list_outputs(first_build_dir)
+        second_outputs = list_outputs(second_build_dir)
+
+        differences = sorted(first_outputs ^ second_outputs)
+        for output in sorted(first_outputs & second_outputs):
+            if not filecmp.cmp(f"{first_build_dir}{os.sep}{output}", f"{second_build_dir}{os.sep}{output}",
+                               shallow=False):
+                log.info("%s differs", output)
+                differences.append(output)
+        return differences